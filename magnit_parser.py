@@ -1,13 +1,20 @@
 import argparse
 import csv
+import functools
+import math
 import os
 import re
 import sys
+import threading
 import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
 from dataclasses import dataclass
-from typing import Any, Dict, Iterable, List, Optional, Tuple
+from pathlib import Path
+from typing import Any, Deque, Dict, Iterable, List, Optional, Tuple
 
-import requests
+import httpx
+import orjson
 
 
 BASE_URL = "https://middle-api.magnit.ru"
@@ -17,6 +24,24 @@ CATALOG_TYPE = "4"
 STORE_CODE = "000"
 
 DEFAULT_LIMIT = 20
+# сколько страниц поиска запрашиваем параллельно
+DEFAULT_WORKERS = 8
+# на сколько страниц вперёд запрашиваем, пока не убедились, что search token
+# между страницами не меняется
+SPECULATIVE_PAGES = 3
+
+CSV_BUFFER_SIZE = 1 << 20
+
+# повторы запросов на 429/5xx
+RETRY_STATUSES = frozenset({429, 500, 502, 503, 504})
+RETRY_TOTAL = 3
+RETRY_BACKOFF_SEC = 0.3
+# больше не ждём, даже если Retry-After просит
+RETRY_AFTER_MAX_SEC = 60.0
+
+# кэш cityId и id категории между запусками (например, при запуске по cron)
+CACHE_PATH = Path.home() / ".cache" / "magnit_parser.json"
+CACHE_TTL_SEC = 24 * 60 * 60
 
 # FIAS ID из HAR:
 FIAS_SPB = "c2deb16a-0330-4f05-821f-1d09c93331e6"
@@ -37,8 +62,12 @@ KNOWN_CITIES = {
     "spb": FIAS_SPB,
 }
 
+# мягкое совпадение по KNOWN_CITIES одним проходом: группа k<i> -> i-й ключ
+_CITY_PATTERN = re.compile("|".join(f"(?P<k{i}>{re.escape(k)})" for i, k in enumerate(KNOWN_CITIES)))
+_CITY_VALUES = list(KNOWN_CITIES.values())
 
-@dataclass
+
+@dataclass(slots=True, frozen=True)
 class ProductRow:
     product_id: str
     name: str
@@ -48,63 +77,159 @@ class ProductRow:
     city: str
 
 
-def money_from_int(value: Optional[int]) -> Optional[float]:
-    # цены в ответах приходят целыми (обычно копейки) -> рубли
-    if value is None:
-        return None
-    return round(value / 100.0, 2)
+_PREFIX_RE = re.compile(r"^(кофе|кофейный\s+напиток|кофейные\s+напитки)\s+", re.I)
+# латиница с заглавной | кириллица с заглавной | КАПС/цифры
+_BRAND_RE = re.compile(r"^(?:[A-Z][A-Za-z0-9\-]+|[А-ЯЁ][А-Яа-яЁё0-9\-]+|[A-Z0-9\-]{2,})$")
+# скобки/кавычки срезаем по краям токена, «ёлочки» убираем целиком
+_BRAND_STRIP = "()[]{}\"'"
+_TRANSLATE = str.maketrans("", "", "«»")
+
+_BRAND_SKIP = frozenset({
+    "растворимый", "молотый", "зерновой", "натуральный", "жареный",
+    "сублимированный", "в", "капсулах", "дрип", "дрип-пакетах",
+    "смесь", "для", "кофемашин", "эспрессо", "арабика", "робуста",
+    "вес", "г", "кг", "мл",
+})
 
 
+@functools.lru_cache(maxsize=4096)
 def extract_brand_from_name(name: str) -> str:
     # В HAR brand отдельным полем не приходит -> best-effort из названия
     s = name.strip()
-    s = re.sub(r"^(кофе|кофейный\s+напиток|кофейные\s+напитки)\s+", "", s, flags=re.I)
-    tokens = re.split(r"[\s,]+", s)
+    # все варианты префикса начинаются с "кофе" -> без него regex не нужен
+    if s[:4].lower() == "кофе":
+        s = _PREFIX_RE.sub("", s)
+    tokens = s.replace(",", " ").split()
     if not tokens:
         return ""
 
-    skip = {
-        "растворимый", "молотый", "зерновой", "натуральный", "жареный",
-        "сублимированный", "в", "капсулах", "дрип", "дрип-пакетах",
-        "смесь", "для", "кофемашин", "эспрессо", "арабика", "робуста",
-        "вес", "г", "кг", "мл",
-    }
-
     for t in tokens:
-        tt = t.strip().strip("()[]{}\"'").replace("«", "").replace("»", "")
-        if not tt or tt.lower() in skip:
+        tt = t.strip(_BRAND_STRIP).translate(_TRANSLATE)
+        if not tt or tt.lower() in _BRAND_SKIP:
             continue
-        if re.match(r"^[A-Z][A-Za-z0-9\-]+$", tt) or re.match(r"^[А-ЯЁ][А-Яа-яЁё0-9\-]+$", tt):
-            return tt
-        if re.match(r"^[A-Z0-9\-]{2,}$", tt):
+        if _BRAND_RE.match(tt):
             return tt
 
     for t in tokens:
-        tt = t.strip().strip("()[]{}\"'").replace("«", "").replace("»", "")
-        if tt and tt.lower() not in skip:
+        tt = t.strip(_BRAND_STRIP).translate(_TRANSLATE)
+        if tt and tt.lower() not in _BRAND_SKIP:
             return tt
 
     return ""
 
 
-def make_session(token: str, device_id: str, app_version: str, user_agent: str) -> requests.Session:
-    s = requests.Session()
-    s.headers.update({
-        "authorization": f"bearer {token}",
-        "x-device-id": device_id,
-        "x-app-version": app_version,
-        "user-agent": user_agent,
-        "content-type": "application/json; charset=UTF-8",
-        "accept": "application/json",
-    })
-    return s
+def make_session(
+    token: str,
+    device_id: str,
+    app_version: str,
+    user_agent: str,
+    workers: int = DEFAULT_WORKERS,
+) -> httpx.Client:
+    # Один клиент на весь запуск: resolve_city, get_coffee_category_id и все
+    # страницы goods_search_page ходят через него. По HTTP/2 параллельные
+    # страницы идут потоками в одном TLS-соединении; если сервер согласует
+    # только HTTP/1.1, пул откроет до `workers` соединений.
+    # Временные клиенты не создаём.
+    limits = httpx.Limits(max_connections=workers, max_keepalive_connections=workers)
+    return httpx.Client(
+        http2=True,
+        limits=limits,
+        headers={
+            "authorization": f"bearer {token}",
+            "x-device-id": device_id,
+            "x-app-version": app_version,
+            "user-agent": user_agent,
+            "content-type": "application/json; charset=UTF-8",
+            "accept": "application/json",
+        },
+        timeout=30,
+    )
+
+
+def _pause(delay: float, cancel: Optional[threading.Event]) -> bool:
+    # True, если ожидание прервали через cancel
+    if cancel is None:
+        time.sleep(delay)
+        return False
+    return cancel.wait(delay)
+
+
+def _send(
+    session: httpx.Client,
+    method: str,
+    url: str,
+    cancel: Optional[threading.Event] = None,
+    **kwargs: Any,
+) -> httpx.Response:
+    # повторы на ошибки соединения и 429/5xx с экспоненциальной паузой
+    # (на 429 ждём Retry-After, если сервер его прислал); cancel прерывает
+    # паузу между повторами и отдаёт последнюю ошибку
+    for attempt in range(RETRY_TOTAL + 1):
+        delay = RETRY_BACKOFF_SEC * 2 ** attempt
+        try:
+            r = session.request(method, url, **kwargs)
+        except httpx.ConnectError:
+            if attempt == RETRY_TOTAL or _pause(delay, cancel):
+                raise
+            continue
+        if r.status_code not in RETRY_STATUSES or attempt == RETRY_TOTAL:
+            break
+        if r.status_code == 429:
+            try:
+                retry_after = float(r.headers.get("retry-after", delay))
+            except ValueError:
+                # Retry-After в виде HTTP-даты не разбираем
+                retry_after = math.nan
+            if math.isfinite(retry_after):
+                delay = min(max(retry_after, 0.0), RETRY_AFTER_MAX_SEC)
+        if _pause(delay, cancel):
+            break
+    r.raise_for_status()
+    return r
+
+
+def _load_cache() -> Dict[str, Any]:
+    try:
+        cache = orjson.loads(CACHE_PATH.read_bytes())
+    except (OSError, orjson.JSONDecodeError):
+        return {}
+    return cache if isinstance(cache, dict) else {}
 
 
-def resolve_city(session: requests.Session, city: Optional[str], fias_id: Optional[str]) -> Tuple[str, str, str]:
+def _cache_get(key: str) -> Any:
+    # битая запись -> промах, как будто кэша нет
+    entry = _load_cache().get(key)
+    if not isinstance(entry, dict):
+        return None
+    ts = entry.get("ts")
+    if not isinstance(ts, (int, float)) or time.time() - ts > CACHE_TTL_SEC:
+        return None
+    return entry.get("value")
+
+
+def _cache_put(key: str, value: Any) -> None:
+    cache = _load_cache()
+    cache[key] = {"ts": time.time(), "value": value}
+    try:
+        CACHE_PATH.parent.mkdir(parents=True, exist_ok=True)
+        CACHE_PATH.write_bytes(orjson.dumps(cache))
+    except OSError:
+        # кэш — только оптимизация, без него всё работает
+        pass
+
+
+def resolve_city(
+    session: httpx.Client,
+    city: Optional[str],
+    fias_id: Optional[str],
+    use_cache: bool = True,
+) -> Tuple[str, str, str]:
     """
     Получаем cityId и красивое имя города строго через эндпоинт приложения:
       POST /market/v2/city/info  { "fiasId": "..." }
 
+    Ответ кэшируется на диске (CACHE_PATH) на CACHE_TTL_SEC.
+
     Возвращает: (city_id, city_name, fias_id)
     """
     fias = None
@@ -117,10 +242,9 @@ def resolve_city(session: requests.Session, city: Optional[str], fias_id: Option
 
         # мягкие совпадения для ввода типа "Москва, РФ"
         if fias is None:
-            for k, v in KNOWN_CITIES.items():
-                if k in key:
-                    fias = v
-                    break
+            m = _CITY_PATTERN.search(key)
+            if m:
+                fias = _CITY_VALUES[int(m.lastgroup[1:])]
 
     if not fias:
         raise RuntimeError(
@@ -130,10 +254,16 @@ def resolve_city(session: requests.Session, city: Optional[str], fias_id: Option
             "  2) Для любого другого города передайте --fias-id <UUID> (как делает приложение в HAR)\n"
         )
 
-    url = f"{BASE_URL}/market/v2/city/info"
-    r = session.post(url, json={"fiasId": fias}, timeout=30)
-    r.raise_for_status()
-    data = r.json()
+    cache_key = f"city:{fias}"
+    cached = _cache_get(cache_key) if use_cache else None
+    if not isinstance(cached, dict) or not cached.get("cityId"):
+        cached = None
+    if cached is not None:
+        data = cached
+    else:
+        url = f"{BASE_URL}/market/v2/city/info"
+        r = _send(session, "POST", url, content=orjson.dumps({"fiasId": fias}))
+        data = orjson.loads(r.content)
 
     city_id = str(data.get("cityId", "")).strip()
     city_name = str(data.get("name", "")).strip() or (city or "")
@@ -141,44 +271,79 @@ def resolve_city(session: requests.Session, city: Optional[str], fias_id: Option
     if not city_id:
         raise RuntimeError(f"city/info не вернул cityId для fiasId={fias}")
 
+    if use_cache and cached is None:
+        _cache_put(cache_key, {"cityId": city_id, "name": data.get("name", "")})
     return city_id, city_name, fias
 
 
-def get_coffee_category_id(session: requests.Session) -> int:
+def _find_category_id_shallow(items: List[Dict[str, Any]], name: str) -> Optional[int]:
+    # обычная форма ответа: items -> children -> children, без проверок типов
+    for top in items:
+        if top.get("name") == name:
+            return int(top["id"])
+        for ch in top.get("children") or []:
+            if ch.get("name") == name:
+                return int(ch["id"])
+            for gc in ch.get("children") or []:
+                if gc.get("name") == name:
+                    return int(gc["id"])
+    return None
+
+
+def _find_category_id(nodes: Any, name: str) -> Optional[int]:
+    # обход произвольного дерева в глубину без рекурсии;
+    # reversed() сохраняет порядок обхода
+    stack: List[Any] = [nodes]
+    while stack:
+        node = stack.pop()
+        if isinstance(node, dict):
+            if node.get("name") == name:
+                return int(node["id"])
+            stack.extend(reversed(node.get("children", []) or []))
+        elif isinstance(node, list):
+            stack.extend(reversed(node))
+    return None
+
+
+def get_coffee_category_id(session: httpx.Client, use_cache: bool = True) -> int:
+    # дерево категорий меняется редко -> id берём из кэша, если он свежий
+    cache_key = f"coffee_category:{STORE_TYPE}:{CATALOG_TYPE}:{STORE_CODE}"
+    cached = _cache_get(cache_key) if use_cache else None
+    if cached is not None:
+        try:
+            return int(cached)
+        except (TypeError, ValueError):
+            pass
+
     url = f"{BASE_URL}/v3/categories/store/{STORE_CODE}"
     params = {"storetype": STORE_TYPE, "catalogtype": CATALOG_TYPE}
-    r = session.get(url, params=params, timeout=30)
-    r.raise_for_status()
-    data = r.json()
-
-    def walk(nodes: Any) -> Optional[int]:
-        if isinstance(nodes, dict):
-            if nodes.get("name") == "Кофе":
-                return int(nodes["id"])
-            for ch in nodes.get("children", []) or []:
-                found = walk(ch)
-                if found is not None:
-                    return found
-        elif isinstance(nodes, list):
-            for n in nodes:
-                found = walk(n)
-                if found is not None:
-                    return found
-        return None
+    r = _send(session, "GET", url, params=params)
+    data = orjson.loads(r.content)
+
+    items = data.get("items", [])
+    try:
+        cid = _find_category_id_shallow(items, "Кофе")
+    except (AttributeError, TypeError):
+        # дерево не той формы, что мы ожидаем
+        cid = None
+    if cid is None:
+        cid = _find_category_id(items, "Кофе")
 
-    cid = walk(data.get("items", []))
     if cid is None:
         raise RuntimeError("Не нашёл категорию 'Кофе' в дереве категорий.")
+    if use_cache:
+        _cache_put(cache_key, cid)
     return cid
 
 
 def goods_search_page(
-    session: requests.Session,
+    session: httpx.Client,
     category_id: int,
     city_id: str,
     offset: int,
     limit: int,
     token: str = "",
+    cancel: Optional[threading.Event] = None,
 ) -> Tuple[List[Dict[str, Any]], str]:
     url = f"{BASE_URL}/v2/goods/search"
     payload = {
@@ -192,41 +357,85 @@ def goods_search_page(
         "filters": [],
         "token": token or "",
     }
-    r = session.post(url, json=payload, timeout=30)
-    r.raise_for_status()
-    data = r.json()
+    r = _send(session, "POST", url, cancel=cancel, content=orjson.dumps(payload))
+    data = orjson.loads(r.content)
     return data.get("items", []) or [], data.get("token", "") or ""
 
 
 def iter_coffee_products_in_stock(
-    session: requests.Session,
+    session: httpx.Client,
     category_id: int,
     city_id: str,
     limit: int = DEFAULT_LIMIT,
-    sleep_sec: float = 0.2,
+    workers: int = DEFAULT_WORKERS,
+    sleep_sec: float = 0.0,
 ) -> Iterable[Dict[str, Any]]:
+    # search token из ответа передаётся в запрос следующей страницы. Страницы
+    # запрашиваем спекулятивно вперёд с последним известным токеном: сначала
+    # на SPECULATIVE_PAGES, а после первой страницы с совпавшим токеном — на
+    # `workers`. Если очередная страница вернула другой токен, запрошенное
+    # с устаревшим выбрасываем и дальше идём строго по цепочке (одна
+    # страница за раз, как раньше). Общее число товаров API не сообщает,
+    # поэтому идём до первой пустой страницы.
     offset = 0
-    search_token = ""
-    while True:
-        items, search_token = goods_search_page(
-            session=session,
-            category_id=category_id,
-            city_id=city_id,
-            offset=offset,
-            limit=limit,
-            token=search_token,
-        )
-        if not items:
-            break
-
-        for it in items:
-            qty = it.get("quantity")
-            if isinstance(qty, int) and qty > 0:
-                yield it
-
-        offset += limit
-        if sleep_sec:
-            time.sleep(sleep_sec)
+    items, search_token = goods_search_page(
+        session=session,
+        category_id=category_id,
+        city_id=city_id,
+        offset=offset,
+        limit=limit,
+    )
+    depth = min(workers, SPECULATIVE_PAGES)
+    chained = False
+    pending: Deque[Tuple[int, str, Future]] = deque()  # (offset, token, future)
+    # прерывает повторы (_send) у выброшенных запросов, чтобы они не держали
+    # потоки пула паузами на 429
+    cancel = threading.Event()
+    pool = ThreadPoolExecutor(max_workers=workers)
+    try:
+        while items:
+            for it in items:
+                try:
+                    in_stock = (it.get("quantity") or 0) > 0
+                except TypeError:
+                    # нечисловое quantity -> считаем, что товара нет
+                    in_stock = False
+                if in_stock:
+                    yield it
+
+            offset += limit
+            if pending:
+                if pending[0][1] != search_token:
+                    cancel.set()
+                    for _, _, f in pending:
+                        f.cancel()
+                    pending.clear()
+                    cancel = threading.Event()
+                    depth = 1
+                    chained = True
+                elif not chained:
+                    depth = workers
+
+            if sleep_sec:
+                time.sleep(sleep_sec)
+
+            next_offset = pending[-1][0] + limit if pending else offset
+            while len(pending) < depth:
+                pending.append((
+                    next_offset,
+                    search_token,
+                    pool.submit(
+                        goods_search_page, session, category_id, city_id, next_offset, limit, search_token, cancel,
+                    ),
+                ))
+                next_offset += limit
+
+            _, _, fut = pending.popleft()
+            items, search_token = fut.result()
+    finally:
+        # не ждём уже ненужные запросы (в т.ч. на нормальном конце выдачи)
+        cancel.set()
+        pool.shutdown(wait=False, cancel_futures=True)
 
 
 def to_row(it: Dict[str, Any], city_name: str) -> ProductRow:
@@ -236,36 +445,62 @@ def to_row(it: Dict[str, Any], city_name: str) -> ProductRow:
     price = it.get("price")
     old_price = promo.get("oldPrice")
 
-    promo_price = money_from_int(price) if is_promo else None
-    regular_price = money_from_int(old_price) if is_promo and isinstance(old_price, int) else money_from_int(price)
+    # цены в ответах приходят целыми (обычно копейки) -> рубли
+    price_rub = None if price is None else round(price / 100.0, 2)
+    promo_price = price_rub if is_promo else None
+    if is_promo and isinstance(old_price, int):
+        regular_price = round(old_price / 100.0, 2)
+    else:
+        regular_price = price_rub
 
     name = (it.get("name") or "").strip()
-    product_id = str(it.get("productId") or it.get("id") or "").strip()
+    product_id = str(pid).strip() if (pid := it.get("productId") or it.get("id")) else ""
     brand = extract_brand_from_name(name)
 
     return ProductRow(
-        product_id=product_id,
-        name=name,
-        regular_price=regular_price,
-        promo_price=promo_price,
-        brand=brand,
-        city=city_name,
+        product_id,
+        name,
+        regular_price,
+        promo_price,
+        brand,
+        city_name,
     )
 
 
-def write_csv(rows: List[ProductRow], out_path: str) -> None:
-    with open(out_path, "w", newline="", encoding="utf-8-sig") as f:
-        w = csv.writer(f, delimiter=";")
-        w.writerow(["id", "name", "regular_price", "promo_price", "brand", "city"])
+def write_csv(rows: Iterable[ProductRow], out_path: str) -> int:
+    # rows пишем по мере поступления, не собирая в список; возвращает число строк.
+    # Пишем во временный файл рядом и подменяем out_path только после успешной
+    # записи: упавший посреди загрузки запуск не портит прошлый CSV.
+    count = 0
+
+    def records() -> Iterable[Tuple[Any, ...]]:
+        nonlocal count
         for r in rows:
-            w.writerow([
+            count += 1
+            yield (
                 r.product_id,
                 r.name,
                 "" if r.regular_price is None else f"{r.regular_price:.2f}",
                 "" if r.promo_price is None else f"{r.promo_price:.2f}",
                 r.brand,
                 r.city,
-            ])
+            )
+
+    tmp_path = f"{out_path}.{os.getpid()}.tmp"
+    try:
+        # буфер 1 МиБ вместо 8 КиБ по умолчанию -> меньше системных вызовов write
+        with open(tmp_path, "w", buffering=CSV_BUFFER_SIZE, newline="", encoding="utf-8-sig") as f:
+            w = csv.writer(f, delimiter=";")
+            w.writerow(["id", "name", "regular_price", "promo_price", "brand", "city"])
+            w.writerows(records())
+        os.replace(tmp_path, out_path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+    return count
 
 
 def main() -> int:
@@ -284,7 +519,13 @@ def main() -> int:
     p.add_argument("--fias-id", help="FIAS UUID города (как использует приложение)")
     p.add_argument("--out", default="coffee.csv", help="Путь к CSV")
     p.add_argument("--limit", type=int, default=DEFAULT_LIMIT, help="Размер страницы (в HAR = 20)")
+    p.add_argument("--no-cache", action="store_true",
+                   help=f"Не использовать кэш cityId/категории ({CACHE_PATH})")
+    p.add_argument("--workers", type=int, default=DEFAULT_WORKERS,
+                   help="Сколько страниц запрашивать параллельно")
     args = p.parse_args()
+    if args.workers < 1:
+        p.error("--workers должно быть >= 1")
 
     if not args.token or not args.device_id:
         print(
@@ -294,21 +535,21 @@ def main() -> int:
         )
         return 2
 
-    session = make_session(args.token, args.device_id, args.app_version, args.user_agent)
-
-    # 1) Определяем cityId через /market/v2/city/info (по FIAS)
-    city_id, city_name, fias = resolve_city(session, args.city, args.fias_id)
+    with make_session(
+        args.token, args.device_id, args.app_version, args.user_agent, workers=args.workers,
+    ) as session:
+        # 1) Определяем cityId через /market/v2/city/info (по FIAS)
+        city_id, city_name, fias = resolve_city(session, args.city, args.fias_id, use_cache=not args.no_cache)
 
-    # 2) Категория "Кофе"
-    coffee_category_id = get_coffee_category_id(session)
+        # 2) Категория "Кофе"
+        coffee_category_id = get_coffee_category_id(session, use_cache=not args.no_cache)
 
-    # 3) Парсинг товаров в наличии
-    rows: List[ProductRow] = []
-    for it in iter_coffee_products_in_stock(session, coffee_category_id, city_id, limit=args.limit):
-        rows.append(to_row(it, city_name))
-
-    write_csv(rows, args.out)
-    print(f"OK: город={city_name} (cityId={city_id}, fiasId={fias}) | выгружено {len(rows)} товаров (в наличии) -> {args.out}")
+        # 3) Парсинг товаров в наличии
+        items = iter_coffee_products_in_stock(
+            session, coffee_category_id, city_id, limit=args.limit, workers=args.workers,
+        )
+        count = write_csv(map(functools.partial(to_row, city_name=city_name), items), args.out)
+        print(f"OK: город={city_name} (cityId={city_id}, fiasId={fias}) | выгружено {count} товаров (в наличии) -> {args.out}")
     return 0
 
 